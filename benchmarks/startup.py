@@ -0,0 +1,49 @@
+"""
+Measures how long `phelng -l` takes to start, and checks that listing the library
+doesn't import the heavy dependencies (or authenticate with Spotify).
+
+Usage: poetry run python benchmarks/startup.py [RUNS]
+"""
+from statistics import median
+from tempfile import NamedTemporaryFile
+from time import perf_counter
+import subprocess
+import sys
+
+HEAVY_MODULES = ("youtube_dl", "spotipy", "eyed3", "pydub", "bs4", "PyInquirer", "requests")
+BUDGET = 0.2  # seconds
+
+LIST_LIBRARY = """
+import sys
+sys.argv = ["phelng", "-l", {library!r}]
+from phelng.cli import run
+run()
+heavy = [m for m in {heavy!r} if m in sys.modules]
+if heavy:
+    sys.exit("imported by phelng -l: " + ", ".join(heavy))
+"""
+
+
+def time_run(library: str) -> float:
+    start = perf_counter()
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            LIST_LIBRARY.format(library=library, heavy=HEAVY_MODULES),
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return perf_counter() - start
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    with NamedTemporaryFile("w", suffix=".tsv") as library:
+        library.write("Geotic\tSwiss Bicycle\n" + "Four Tet\tTwo Thousand and Seventeen\tNew Energy\n")
+        library.flush()
+        timings = [time_run(library.name) for _ in range(runs)]
+    print(f"phelng -l: median {median(timings) * 1000:.0f} ms over {runs} runs (budget: {BUDGET * 1000:.0f} ms)")
+    if median(timings) > BUDGET:
+        sys.exit(1)
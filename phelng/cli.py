@@ -30,6 +30,8 @@ Usage:
     phelng [-l] [-d] [-n] [-t] [options] FILE...
     phelng -a [-l] [-d] [-n] [-t] [options] FILE
     phelng [-d] [-n] [-t] [options] artist=ARTIST title=TITLE [album=ALBUM]
+    phelng --merge-shards [options] FILE...
+    phelng --from-plan PLAN [-n] [-t] [options]
 
 Options:
     -p --parallel-downloads INTEGER    Download up to INTEGER tracks in parallel
@@ -41,6 +43,30 @@ Options:
                                        than the track will not be selected for download [default: 5]
     --whitelisted-channels             Tracks will be downloaded from these channels if no video from
                                        the artist's own channel is found.
+    -w --watch                         After running the actions, keep running and download the rows
+                                       appended to FILE as they come in. Clients and connections are
+                                       reused for the lifetime of the process.
+    --watch-interval SECONDS           Check FILE for appended rows every SECONDS seconds [default: 2]
+    --shard I/N                        Only process the rows of the I-th of N shards. Rows are assigned
+                                       to shards by a stable hash, so that N machines can each
+                                       process a part of the library without coordinating.
+                                       Completed rows are recorded in the shard's manifest.
+    --shard-manifests DIRECTORY        Where to store the shards' manifests [default: .phelng-shards]
+    --normalize-mode MODE              How to normalize the volume with --normalize: "reencode" applies
+                                       a gain to the audio itself, "tags" measures its loudness
+                                       (EBU R128) and writes ReplayGain & R128 tags, which is lossless
+                                       and much faster [default: reencode]
+    --resolve-only PLAN                Instead of downloading, look up the tracks on Spotify & YouTube
+                                       and save the results to PLAN, to be used with --from-plan
+    --from-plan PLAN                   Download the tracks of PLAN without calling Spotify or
+                                       searching YouTube. Videos are ranked again from the saved
+                                       search results, so options like --duration-exclude-margin
+                                       can be changed without resolving everything again.
+    --profile DIRECTORY                Profile each stage of the pipeline separately (cProfile and
+                                       tracemalloc), and save the results to DIRECTORY
+    --profile-every INTEGER            With --profile, only profile one track out of INTEGER [default: 1]
+    --merge-shards                     Combine the shards' manifests, and print the rows of FILE
+                                       that no shard completed
 
 Actions (combinable, executed in the presented order):
 If no actions are provided, `-dtn` is assumed.
@@ -53,14 +79,10 @@ If no actions are provided, `-dtn` is assumed.
 """
 from os import rename
 from os import path
-from phelng.normalize import normalize_file
-from phelng.youtube import search
-from phelng.ranker import Ranker
 from typing import *
 import docopt
 from wcwidth import wcswidth
-from phelng.metadata import SpotifyClient, Track, TrackSpotify, apply_metadata
-from phelng.downloader import Downloader
+from phelng.metadata import SpotifyClient, Track, TrackSpotify, tag_writes
 from phelng.utils import (
     cache_dir,
     create_missing_files,
@@ -70,19 +92,28 @@ from phelng.utils import (
     cprint
 )
 from phelng.library_files import (
+    LibraryIndex,
     append_tracks_to_library,
     merge_tsv_files,
     parse_tsv_lines,
 )
-from PyInquirer import prompt, ValidationError, Validator
-from pastel import colorize
+from phelng.shards import ShardManifest, merge_manifests, parse_shard
+from phelng.dedupe import Deduplicator
+from phelng.plan import PlanWriter, Resolution, read_plan
+from phelng.sync import PlaylistSyncState, SyncStates
+from phelng.profiling import stage, start_profiling
+from time import perf_counter
 import re
 import sys
 
+# Stands for the user's saved tracks where a playlist ID is expected
+SAVED_TRACKS = "saved-tracks"
+
 
 def run():
     args = docopt.docopt(__doc__)
     files = args["FILE"]
+    # Authenticates with Spotify on first use only, so that eg. --list doesn't need to authenticate
     spotify = SpotifyClient()
     if args["--add-to"]:
         create_missing_files(*files)
@@ -90,102 +121,331 @@ def run():
             print("Please specify exactly one file in the --add-to mode")
             exit(1)
 
-        chosen_playlist = choose_playlist(spotify)
-        append_tracks_to_library(chosen_playlist, append_to=files[0])
+        sync_playlist(spotify, choose_playlist(spotify), library_file=files[0])
     check_all_files_exist(files)
-    library = merge_tsv_files(files)
-    library = parse_tsv_lines(library)
+    # Start following the files before reading them, so that no row appended
+    # while the library is being processed gets missed by --watch
+    tail = None
+    if args["--watch"]:
+        from phelng.watch import LibraryTail
+
+        tail = LibraryTail(files)
+    rows = merge_tsv_files(files)
+    library = parse_tsv_lines(rows)
     library = list(library)
 
+    if args["--normalize-mode"] not in ("reencode", "tags"):
+        print("--normalize-mode must be either reencode or tags")
+        exit(1)
+
+    if not args["--profile-every"].isdigit() or int(args["--profile-every"]) < 1:
+        print("--profile-every must be a positive integer")
+        exit(1)
+
+    if args["--merge-shards"]:
+        merge_shards(library, args["--shard-manifests"])
+        return
+
+    plan: Optional[Dict[Track, Resolution]] = None
+    if args["--from-plan"]:
+        check_all_files_exist([args["--from-plan"]])
+        plan = {
+            resolution.track: resolution for resolution in read_plan(args["--from-plan"])
+        }
+        library = list(plan)
+    plan_writer = PlanWriter(args["--resolve-only"]) if args["--resolve-only"] else None
+
+    shard, manifest = None, None
+    if args["--shard"]:
+        try:
+            shard = parse_shard(args["--shard"])
+        except ValueError as error:
+            print(error)
+            exit(1)
+        manifest = ShardManifest(shard, args["--shard-manifests"])
+        library = [track for track in library if track in shard]
+        cprint(f"<b>Shard:</b>       {shard} <dim>—</dim> {len(library)} <dim>track(s)</dim>")
+
+    # Duplicates need their own copy of the audio if they are tagged separately
+    dedupe = Deduplicator(independent_copies=bool(args["--tag"]))
+
+    profiler = None
+    if args["--profile"]:
+        profiler = start_profiling(args["--profile"], every=int(args["--profile-every"]))
+
+    def download(track: Track) -> None:
+        if shard and track not in shard:
+            return
+        if profiler:
+            profiler.next_track()
+        if plan is not None:
+            resolution = rerank(plan[track], args)
+        else:
+            resolution = resolve_track(track, args, spotify)
+        if plan_writer:
+            plan_writer.add(resolution)
+            return
+        filename = download_resolved(resolution, args, dedupe)
+        if manifest:
+            manifest.record(track, filename)
+
     if args["--list"]:
         show_library(library)
-    if args["--download"] or args["--tag"]:
-        spotify = SpotifyClient()
-    if args["--download"]:
+    if args["--download"] or args["--resolve-only"] or args["--from-plan"]:
         for track in library:
-            print("\n")
-            cprint(f"{track.artist} <dim>—</dim> <b>{track.title}</b>{ ' <dim>[</dim>' + track.album + '<dim>]</dim>' if track.album else ''}")
-            # cprint(
-            #     f"<b>Track:</b>       <dim>artist:</dim>{track.artist} <dim>title:</dim>{track.title} <dim>album:</dim>{track.album}"
-            # )
-            cprint(
-                f"<b>Spotify:</b>     <dim>Searching for</dim> {spotify._build_search_query(track)}"
-            )
-            metadata = spotify.get_appropriate_track(track)
-            if metadata:
-                cprint(
-                    f"<b>Metadata:</b>    <dim>artist:</dim>{metadata.artist} <dim>title:</dim>{metadata.title} <dim>album:</dim>{metadata.album}"
-                )
-                cprint(
-                    f"             <dim>track_number:</dim>{metadata.track_number} <dim>duration:</dim>{metadata.duration}s <dim>release_date:</dim>{metadata.release_date and metadata.release_date.isoformat()}"
-                )
-                cprint(
-                    f"             <dim>total_tracks:</dim>{metadata.total_tracks} <dim>cover_art_url:</dim>{metadata.cover_art_url}"
-                )
-            else:
-                metadata = track
-                cprint(f"<b>Spotify:</b>\n  <red>Error:     No search results</red>")
+            download(track)
+        print("\n")
+        if plan_writer:
+            cprint(f"<b>Plan:</b>        <dim>Saved to</dim> {plan_writer.filepath}")
+        else:
+            cprint(f"<b>Deduplicated:</b> {dedupe.report()}")
+            report_tag_writes()
+        if profiler and not args["--watch"]:
+            cprint(f"<b>Profile:</b>     <dim>Summary saved to</dim> {profiler.write()}")
+    if args["--watch"]:
+        from phelng.watch import watch
 
-            # Get YouTube video URL to download
-            ranker = Ranker(args, metadata)
-            query = f"{metadata.artist} {metadata.title}" + (
-                f" {track.album}" if track.album else ""
-            )
-            cprint(f"<b>YouTube:</b>     <dim>Searching for </dim>{query}")
-            videos = search(query)
-            if not len(videos):
-                cprint(f"  <red>Error:       No results found.</red>")
-                continue
-            video = ranker.select(videos)
-            if video is None:
-                cprint(
-                    f"<b>YouTube:</b>     <red>No videos that satisfy filtering conditions. Try to adjust settings like <b>--duration-exclude-margin</b></red>"
-                )
-                continue
-            cprint(
-                f"<b>Selected:</b>    {video.title} <dim>by</dim> {video.uploader_name}\n             <dim>at</dim> {video.url}"
-            )
-            filename = (
-                make_filename_safe(
-                    f"{metadata.artist}—{metadata.title}"
-                    + (f"—{metadata.album}" if track.album else "")
-                ).lower()
-                + ".mp3"
-            )
-            cprint(f"<b>Saving as:</b>   {filename.replace('.mp3', '<options=dark>.mp3</>')}")
+        watch(
+            tail,
+            on_track=download,
+            seen=rows,
+            interval=float(args["--watch-interval"]),
+        )
+        cprint(f"<b>Deduplicated:</b> {dedupe.report()}")
+        report_tag_writes()
+        if profiler:
+            cprint(f"<b>Profile:</b>     <dim>Summary saved to</dim> {profiler.write()}")
+
+
+def print_track_header(track: Track) -> None:
+    print("\n")
+    cprint(f"{track.artist} <dim>—</dim> <b>{track.title}</b>{ ' <dim>[</dim>' + track.album + '<dim>]</dim>' if track.album else ''}")
+
+
+def resolve_track(track: Track, args: Dict[str, Any], spotify: SpotifyClient) -> Resolution:
+    """
+    Looks `track` up on Spotify, searches for it on YouTube and selects the video to download
+    """
+    from phelng.ranker import Ranker
+    from phelng.youtube import search_many
+
+    print_track_header(track)
+    # cprint(
+    #     f"<b>Track:</b>       <dim>artist:</dim>{track.artist} <dim>title:</dim>{track.title} <dim>album:</dim>{track.album}"
+    # )
+    cprint(
+        f"<b>Spotify:</b>     <dim>Searching for</dim> {spotify._build_search_query(track)}"
+    )
+    with stage("spotify"):
+        metadata = spotify.get_appropriate_track(track)
+    if metadata:
+        cprint(
+            f"<b>Metadata:</b>    <dim>artist:</dim>{metadata.artist} <dim>title:</dim>{metadata.title} <dim>album:</dim>{metadata.album}"
+        )
+        cprint(
+            f"             <dim>track_number:</dim>{metadata.track_number} <dim>duration:</dim>{metadata.duration}s <dim>release_date:</dim>{metadata.release_date and metadata.release_date.isoformat()}"
+        )
+        cprint(
+            f"             <dim>total_tracks:</dim>{metadata.total_tracks} <dim>cover_art_url:</dim>{metadata.cover_art_url}"
+        )
+    else:
+        metadata = track
+        cprint(f"<b>Spotify:</b>\n  <red>Error:     No search results</red>")
+
+    # Get YouTube video URL to download
+    ranker = Ranker(args, metadata)
+    queries = build_search_queries(track, metadata)
+    cprint(
+        f"<b>YouTube:</b>     <dim>Searching for </dim>{queries[0]}"
+        + (f" <dim>and {len(queries) - 1} variant(s)</dim>" if len(queries) > 1 else "")
+    )
+    with stage("youtube-search"):
+        videos = search_many(queries, stop_when=ranker.is_obvious_choice)
+    if not len(videos):
+        cprint(f"  <red>Error:       No results found.</red>")
+        return Resolution(track=track, metadata=metadata, candidates=[], video=None)
+    with stage("ranking"):
+        video = ranker.select(videos)
+    if video is None:
+        cprint(
+            f"<b>YouTube:</b>     <red>No videos that satisfy filtering conditions. Try to adjust settings like <b>--duration-exclude-margin</b></red>"
+        )
+    return Resolution(track=track, metadata=metadata, candidates=videos, video=video)
+
+
+def rerank(resolution: Resolution, args: Dict[str, Any]) -> Resolution:
+    """
+    Selects the video to download again, from the candidates saved in a plan
+    """
+    from phelng.ranker import Ranker
+
+    print_track_header(resolution.track)
+    cprint(f"<b>Plan:</b>        {len(resolution.candidates)} <dim>candidate(s)</dim>")
+    if not resolution.candidates:
+        cprint(f"  <red>Error:       No results found.</red>")
+        return resolution
+    with stage("ranking"):
+        video = Ranker(args, resolution.metadata).select(resolution.candidates)
+    if video is None:
+        cprint(
+            f"<b>YouTube:</b>     <red>No videos that satisfy filtering conditions. Try to adjust settings like <b>--duration-exclude-margin</b></red>"
+        )
+    return resolution._replace(video=video)
+
+
+def download_resolved(
+    resolution: Resolution, args: Dict[str, Any], dedupe: Optional[Deduplicator] = None
+) -> Optional[str]:
+    """
+    Downloads the resolved track (and tags & normalizes it, if asked for).
+    Returns the filename of the downloaded file, or None if the download failed.
+    With `dedupe`, audio that was already produced during this run is reused
+    instead of being downloaded and normalized again.
+    """
+    from phelng.downloader import Downloader
+    from phelng.metadata import apply_loudness_tags, apply_metadata
+    from phelng.normalize import measure_loudness, normalize_file
+
+    track, metadata, video = resolution.track, resolution.metadata, resolution.video
+    if video is None:
+        return None
+    cprint(
+        f"<b>Selected:</b>    {video.title} <dim>by</dim> {video.uploader_name}\n             <dim>at</dim> {video.url}"
+    )
+    filename = (
+        make_filename_safe(
+            f"{metadata.artist}—{metadata.title}"
+            + (f"—{metadata.album}" if track.album else "")
+        ).lower()
+        + ".mp3"
+    )
+    cprint(f"<b>Saving as:</b>   {filename.replace('.mp3', '<options=dark>.mp3</>')}")
+    started_at = perf_counter()
+    stored = dedupe.lookup(video.video_id) if dedupe else None
+    if stored == filename:
+        cprint(f"<b>Duplicate:</b>   <dim>Already downloaded</dim>")
+        downloaded = True
+    elif stored:
+        method = dedupe.duplicate(stored, filename, downloaded=False)
+        cprint(f"<b>Duplicate:</b>   <dim>Same video as</dim> {stored}<dim>, made a {method}</dim>")
+        downloaded = True
+    else:
+        with stage("download"):
             try:
                 Downloader().download(
                     video.url, save_as=filename.replace(".mp3", ".%(ext)s")
                 )
             except Exception:
                 cprint(f"<red>  Error:     Error while downloading with youtube-dl</red>")
-            if args["--tag"]:
-                cprint(f"<b>Tags:</b>        <dim>Applying to</dim> {filename}")
-                apply_metadata(
+                downloaded = False
+            else:
+                downloaded = True
+        if downloaded and dedupe and path.exists(filename):
+            with stage("dedupe"):
+                stored = dedupe.register(video.video_id, filename)
+            if stored:
+                cprint(f"<b>Duplicate:</b>   <dim>Same audio as</dim> {stored}")
+    if args["--tag"]:
+        cprint(f"<b>Tags:</b>        <dim>Applying to</dim> {filename}")
+        with stage("tags"):
+            apply_metadata(
+                filename,
+                metadata,
+                errors_hook=lambda msg: print(f"  Error:     {msg}"),
+            )
+    # Duplicates share the stored file's audio, which is already normalized
+    if args["--normalize"] and not stored and args["--normalize-mode"] == "tags":
+        cprint(f"<b>Normalize:</b>   <dim>Measuring the loudness of</dim> {filename}")
+        with stage("normalize"):
+            try:
+                loudness = measure_loudness(filename)
+            except Exception as e:
+                cprint(
+                    f"<red><b>  Error:</b>     Couldn't measure the loudness of {filename}</red>"
+                )
+            else:
+                cprint(
+                    f"             {loudness.integrated:.1f} <dim>LUFS, track gain:</dim> {loudness.replaygain_gain:+.2f} <dim>dB</dim>"
+                )
+                apply_loudness_tags(
                     filename,
-                    track,
+                    loudness,
                     errors_hook=lambda msg: print(f"  Error:     {msg}"),
                 )
-            if args["--normalize"]:
-                cprint(f"<b>Normalize:</b>   {filename} <dim>to</dim> 20 <dim>dBFS</dim>")
-                filepath_temp = path.join(cache_dir, "normalize", filename)
-                try:
-                    normalize_file(filename, filepath_temp)
-                    rename(filepath_temp, filename)
-                except Exception as e:
-                    cprint(
-                        f"<red><b>  Error:</b>     Couldn't normalize {filename}</red>"
-                    )
+    elif args["--normalize"] and not stored:
+        cprint(f"<b>Normalize:</b>   {filename} <dim>to</dim> 20 <dim>dBFS</dim>")
+        filepath_temp = path.join(cache_dir, "normalize", filename)
+        with stage("normalize"):
+            try:
+                normalize_file(filename, filepath_temp)
+                rename(filepath_temp, filename)
+            except Exception as e:
+                cprint(
+                    f"<red><b>  Error:</b>     Couldn't normalize {filename}</red>"
+                )
+    if dedupe and downloaded and not stored:
+        dedupe.spent(filename, perf_counter() - started_at)
+    return filename if downloaded else None
+
+
+def report_tag_writes() -> None:
+    if not sum(tag_writes.values()):
+        return
+    cprint(
+        f"<b>Tags:</b>         {tag_writes['new']} <dim>new,</dim>"
+        f" {tag_writes['in place']} <dim>updated in place,</dim>"
+        f" {tag_writes['full rewrite']} <dim>updates needed a full rewrite of the file</dim>"
+    )
+
+
+def build_search_queries(
+    track: Track, metadata: Union[Track, TrackSpotify]
+) -> List[str]:
+    """
+    Builds the YouTube search queries for a track, most specific first:
+    with all of its artists, then with each of them (if there are several),
+    each time with and without the album.
+    """
+    if isinstance(metadata, TrackSpotify):
+        artists = metadata.artists
+    else:
+        artists = [artist.strip() for artist in metadata.artist.split(",")]
+    artists_variants = [" ".join(artists)] + (artists if len(artists) > 1 else [])
+    album = track.album or getattr(metadata, "album", None)
+
+    queries: List[str] = []
+    for artists_variant in artists_variants:
+        query = f"{artists_variant} {metadata.title}"
+        # The album was given explicitly: it is more likely to be relevant
+        if track.album:
+            queries += [f"{query} {album}", query]
+        else:
+            queries += [query] + ([f"{query} {album}"] if album else [])
+    return list(dict.fromkeys(queries))
+
+
+def merge_shards(library: List[Track], manifests_directory: str) -> None:
+    """
+    Reports which rows of the library were completed by a shard, and prints the others
+    in the library file format, so that they can be saved to a new library and retried.
+    """
+    completed, missing = merge_manifests(library, manifests_directory)
+    cprint(
+        f"<b>Shards:</b>      {len(completed)}/{len(library)} <dim>track(s) completed</dim>",
+        file=sys.stderr,
+    )
+    for track in missing:
+        print("\t".join((track.artist, track.title, track.album or "")).rstrip("\t"))
 
 
 def show_library(library: Set[Track], max_cell_width: Optional[int] = None, padding=2):
     max_cell_width = max_cell_width or terminal_width() - padding
     columns_lengths = {
-        "artist": min(max((wcswidth(t.artist) for t in library)), max_cell_width)
+        "artist": min(max((wcswidth(t.artist) for t in library), default=0), max_cell_width)
         + padding,
-        "title": min(max((wcswidth(t.title) for t in library)), max_cell_width)
+        "title": min(max((wcswidth(t.title) for t in library), default=0), max_cell_width)
         + padding,
-        "album": min(max((wcswidth(t.album or "") for t in library)), max_cell_width),
+        "album": min(max((wcswidth(t.album or "") for t in library), default=0), max_cell_width),
     }
     header = Track(artist="ARTIST", title="TITLE", album="ALBUM")
     _print_row(header, columns_lengths)
@@ -209,7 +469,55 @@ def _print_row(track: Track, columns_lengths: Dict[str, int]):
     print(row)
 
 
-def choose_playlist(spotify: SpotifyClient) -> List[TrackSpotify]:
+def sync_playlist(spotify: SpotifyClient, playlist_id: str, library_file: str) -> None:
+    """
+    Appends the playlist's tracks to the library file, except the ones that were already
+    imported from it (the playlist isn't fetched at all if it didn't change since then)
+    and the ones already in the library.
+    """
+    sync_states = SyncStates(library_file)
+    state = sync_states.get(playlist_id)
+    if playlist_id == SAVED_TRACKS:
+        snapshot_id = None
+        print("Getting your saved tracks...", end="")
+        sys.stdout.flush()
+        playlist = spotify.get_saved_tracks(skip_ids=state.track_ids)
+    else:
+        snapshot_id = spotify.get_playlist_snapshot(playlist_id)
+        if state.snapshot_id == snapshot_id:
+            print("The playlist didn't change since it was last added: nothing to add.")
+            return
+        print("Getting the playlist's new tracks...", end="")
+        sys.stdout.flush()
+        playlist = spotify.get_playlist(playlist_id, skip_ids=state.track_ids)
+    print(f" Done: got {len(playlist)} track(s)")
+
+    library_index = LibraryIndex([library_file])
+    new_tracks = []
+    for track in playlist:
+        if track not in library_index:
+            new_tracks.append(track)
+            library_index.add(track)
+    append_tracks_to_library(new_tracks, append_to=library_file)
+    print(
+        f"Added {len(new_tracks)} track(s)"
+        + (f", {len(playlist) - len(new_tracks)} already in the library" if len(new_tracks) < len(playlist) else "")
+    )
+    sync_states.set(
+        playlist_id,
+        PlaylistSyncState(
+            snapshot_id=snapshot_id,
+            track_ids=state.track_ids | {t.spotify_id for t in playlist if t.spotify_id},
+        ),
+    )
+
+
+def choose_playlist(spotify: SpotifyClient) -> str:
+    """
+    Asks for a playlist, and returns its ID (or SAVED_TRACKS)
+    """
+    from PyInquirer import prompt, ValidationError, Validator
+
     playlist_input_method = prompt(
         [
             {
@@ -241,13 +549,8 @@ def choose_playlist(spotify: SpotifyClient) -> List[TrackSpotify]:
             ]
         )["ans"]
         playlist_id = [p for p in playlists if p["name"] == playlist_name][0]["id"]
-        print("Getting the playlist's tracks...", end="")
-        sys.stdout.flush()
-        playlist = spotify.get_playlist(playlist_id)
     elif playlist_input_method == "Using your saved tracks":
-        print("Getting your saved tracks...", end="")
-        sys.stdout.flush()
-        playlist = spotify.get_saved_tracks()
+        playlist_id = SAVED_TRACKS
     else:
 
         class SpotifyPlaylistIDValidator(Validator):
@@ -267,12 +570,7 @@ def choose_playlist(spotify: SpotifyClient) -> List[TrackSpotify]:
                 "validate": SpotifyPlaylistIDValidator,
             }
         )["ans"]
-
-        print("Getting the playlist's tracks...", end="")
-        sys.stdout.flush()
-        playlist = spotify.get_playlist(playlist_id)
-    print(f" Done: got {len(playlist)} track(s)")
-    return playlist
+    return playlist_id
 
 
 if __name__ == "__main__":
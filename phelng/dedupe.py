@@ -0,0 +1,136 @@
+from hashlib import sha256
+from os import link, path, remove
+from shutil import copyfile
+from typing import *
+
+try:
+    from fcntl import ioctl
+except ImportError:  # Not available on Windows
+    ioctl = None
+
+# From linux/fs.h: clones the source file's extents into the destination (copy-on-write)
+FICLONE = 0x40049409
+
+
+def audio_hash(filepath: str) -> str:
+    """
+    Hashes the audio of an mp3 file, leaving out its ID3 tags
+    so that differently-tagged copies of the same audio hash the same.
+    """
+    with open(filepath, "rb") as file:
+        data = file.read()
+    start, end = 0, len(data)
+    # ID3v2 header: "ID3", version (2 bytes), flags, then the tag size as a syncsafe integer
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = 0
+        for byte in data[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        start = 10 + size + (10 if data[5] & 0x10 else 0)  # + footer, if present
+    # ID3v1 tag: the last 128 bytes, starting with "TAG"
+    if data[end - 128 : end - 125] == b"TAG":
+        end -= 128
+    return sha256(data[start:end]).hexdigest()
+
+
+def reflink(source: str, destination: str) -> bool:
+    """
+    Creates `destination` as a copy-on-write clone of `source`.
+    Returns False if the platform or filesystem doesn't support it.
+    """
+    if ioctl is None:
+        return False
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+    remove(destination)
+    return False
+
+
+class Deduplicator:
+    """
+    Keeps track of the files produced during a run, by YouTube video ID and by audio hash,
+    so that rows resolving to the same audio are only downloaded and processed once.
+
+    Duplicates are hardlinked to the stored file when they won't be tagged.
+    Otherwise, they are reflinked (or copied if reflinks are unsupported),
+    since tagging a hardlink would change the tags of every row sharing it.
+    """
+
+    def __init__(self, independent_copies: bool) -> None:
+        self.independent_copies = independent_copies
+        self.by_video_id: Dict[str, str] = {}
+        self.by_audio_hash: Dict[str, str] = {}
+        # Time it took to download and process each stored file
+        self.seconds_spent: Dict[str, float] = {}
+        self.duplicates = 0
+        self.download_bytes_saved = 0
+        self.disk_bytes_saved = 0
+        self.seconds_saved = 0.0
+
+    def lookup(self, video_id: str) -> Optional[str]:
+        """
+        Returns the file already produced from the video `video_id`, if there is one
+        """
+        filename = self.by_video_id.get(video_id)
+        if filename is not None and path.exists(filename):
+            return filename
+        return None
+
+    def register(self, video_id: str, filename: str) -> Optional[str]:
+        """
+        Records that `filename` was just downloaded from `video_id`.
+        If the same audio was already stored under another name,
+        `filename` is replaced by a duplicate of it, and the stored file's name is returned.
+        """
+        self.by_video_id[video_id] = filename
+        digest = audio_hash(filename)
+        stored = self.by_audio_hash.get(digest)
+        if stored is None or stored == filename or not path.exists(stored):
+            self.by_audio_hash[digest] = filename
+            return None
+        self.duplicate(stored, filename)
+        return stored
+
+    def spent(self, filename: str, seconds: float) -> None:
+        """
+        Records how long it took to download and process the stored file `filename`
+        """
+        self.seconds_spent[filename] = seconds
+
+    def duplicate(self, stored: str, filename: str, downloaded: bool = True) -> str:
+        """
+        Makes `filename` a duplicate of `stored`.
+        `downloaded` tells whether `filename` had to be downloaded anyway (duplicate audio
+        from another video) or not (same video).
+        Returns how it was done: "hardlink", "reflink" or "copy".
+        """
+        if path.exists(filename):
+            remove(filename)
+        size = path.getsize(stored)
+        self.duplicates += 1
+        if not downloaded:
+            self.download_bytes_saved += size
+            self.seconds_saved += self.seconds_spent.get(stored, 0)
+        if not self.independent_copies:
+            try:
+                link(stored, filename)
+                self.disk_bytes_saved += size
+                return "hardlink"
+            except OSError:
+                pass
+        if reflink(stored, filename):
+            self.disk_bytes_saved += size
+            return "reflink"
+        copyfile(stored, filename)
+        return "copy"
+
+    def report(self) -> str:
+        return (
+            f"{self.duplicates} <dim>duplicate(s), saved</dim>"
+            f" {self.download_bytes_saved / 1e6:.1f} MB <dim>of downloads,</dim>"
+            f" {self.disk_bytes_saved / 1e6:.1f} MB <dim>of disk space and</dim>"
+            f" {self.seconds_saved:.0f}s"
+        )
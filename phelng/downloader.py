@@ -2,9 +2,7 @@ from os import path
 from typing import *
 from phelng.utils import cache_dir, terminal_width
 from phelng.metadata import Track
-from youtube_dl import YoutubeDL
 import sys
-from pastel import colorize
 from math import floor
 
 
@@ -16,6 +14,9 @@ class Downloader:
         """
         Downloads and returns the downloaded path
         """
+        from pastel import colorize
+        from youtube_dl import YoutubeDL
+
         self.progress_bar = ProgressBar(0, length=80, filled='█', empty=colorize('<options=dark>▒</>'))
         donwloader = YoutubeDL(
             {
@@ -35,12 +36,17 @@ class Downloader:
                         "nopostoverwrites": False
                     }
                 ],
+                # ffmpeg's own ID3 tag has no padding: leave the file untagged,
+                # so that its first tag is written with TAG_PADDING
+                "postprocessor_args": ["-write_id3v2", "0"],
             }
         )
         donwloader.download([youtube_url])
         print("")
 
     def progress_hook(self, d: dict):
+        from pastel import colorize
+
         if d["status"] == "downloading":
             estimation = False
             progress_unknown = False
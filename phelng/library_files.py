@@ -1,6 +1,24 @@
 from typing import *
+import sys
 from phelng.metadata import Track, TrackSpotify
 
+
+def is_library_row(line: str) -> bool:
+    """
+    Whether `line` holds a track (ie. is neither a comment nor empty)
+    """
+    return bool(line) and not line.startswith("\t")
+
+
+def track_key(track: Track) -> str:
+    """
+    Normalizes the track so that rows differing only by case or spacing
+    are considered to be the same track
+    """
+    normalize = lambda cell: " ".join((cell or "").lower().split())
+    return "\t".join((normalize(track.artist), normalize(track.title), normalize(track.album)))
+
+
 def merge_tsv_files(files: List[str]) -> Set[tuple]:
     """
 	Merges filepaths `files` and removes duplicate lines
@@ -8,11 +26,8 @@ def merge_tsv_files(files: List[str]) -> Set[tuple]:
     contents: Set[tuple] = set()
     for file in files:
         for line in open(file).read().split("\n"):
-            # Ignore comments
-            if line.startswith("\t"):
-                continue
-            # Ignore empty lines
-            if not line:
+            # Ignore comments and empty lines
+            if not is_library_row(line):
                 continue
             if line in contents:
                 print(f"warn: {line!r} appears more than once, ignoring duplicates.")
@@ -20,22 +35,58 @@ def merge_tsv_files(files: List[str]) -> Set[tuple]:
     return contents
 
 
+def parse_tsv_line(line: str) -> Track:
+    """
+    Parses a single library row. Raises `ValueError` if the row is malformed.
+    """
+    cells = line.split("\t")
+    if len(cells) == 2:
+        cells = [cells[0], cells[1], None]
+    if len(cells) != 3:
+        raise ValueError(
+            f"rows must have between 2 and 3 values (found {len(cells)})"
+        )
+
+    artist, title, album = cells
+    return Track(artist=artist, title=title, album=album)
+
+
 def parse_tsv_lines(lines: Set[str]) -> Set[Track]:
     parsed = set()
     for line in lines:
-        cells = line.split("\t")
-        if len(cells) == 2:
-            cells = [cells[0], cells[1], None]
-        if len(cells) != 3:
-            print(
-                f"error at line {line!r}: rows must have between 2 and 3 values (found {len(cells)})"
-            )
+        try:
+            parsed.add(parse_tsv_line(line))
+        except ValueError as error:
+            print(f"error at line {line!r}: {error}")
             sys.exit(1)
-
-        artist, title, album = cells
-        parsed.add(Track(artist=artist, title=title, album=album))
     return parsed
 
+class LibraryIndex:
+    """
+    Hashed index of the tracks of library files, to check whether a track is already in them.
+    Rows without an album match a track regardless of its album.
+    """
+
+    def __init__(self, files: List[str]) -> None:
+        self.keys: Set[str] = set()
+        for line in merge_tsv_files(files):
+            try:
+                self.add(parse_tsv_line(line))
+            except ValueError:
+                continue
+
+    def add(self, track: Union[Track, TrackSpotify]) -> None:
+        self.keys.add(track_key(Track(track.artist, track.title, track.album)))
+
+    def __contains__(self, track: Union[Track, TrackSpotify]) -> bool:
+        return (
+            track_key(Track(track.artist, track.title, track.album)) in self.keys
+            or track_key(Track(track.artist, track.title)) in self.keys
+        )
+
+
 def append_tracks_to_library(tracks: List[TrackSpotify], append_to: str) -> None:
+    if not tracks:
+        return
     with open(append_to, "a") as file:
         file.write("\n".join((t.to_tsv() for t in tracks)) + "\n")
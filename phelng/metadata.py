@@ -1,15 +1,26 @@
+from collections import Counter
 from datetime import date
 from os.path import expanduser
 from pprint import pprint
 from shutil import copyfileobj
 import subprocess
 from typing import *
-import eyed3
-from dotenv import load_dotenv
 from os import makedirs, path
 import re
-from spotipy import Spotify, prompt_for_user_token
-import requests
+from phelng.utils import http_session
+
+if TYPE_CHECKING:
+    from spotipy import Spotify, SpotifyOAuth
+    from phelng.normalize import Loudness
+
+
+# Padding reserved in the ID3v2 header whenever a tag has to be written from scratch,
+# so that later updates (eg. a bigger cover art) fit in it and can be written in place
+TAG_PADDING = 256 * 1024
+
+# How many tags were "new" (the file had none), written "in place"
+# or needed a "full rewrite" of their file
+tag_writes: Counter = Counter()
 
 
 class Track(NamedTuple):
@@ -28,6 +39,7 @@ class TrackSpotify(NamedTuple):
     duration: float  # in seconds
     cover_art_url: str
     label: Optional[str]
+    spotify_id: Optional[str] = None
 
     @property
     def cover_art_filepath(self) -> str:
@@ -41,19 +53,41 @@ class TrackSpotify(NamedTuple):
         return "\t".join((self.artist, self.title, self.album))
 
 
-def get_spotify_token() -> str:
+SPOTIFY_USERNAME = "phelng"
+SPOTIFY_SCOPE = "user-library-read streaming user-read-currently-playing user-read-playback-state"
+
+
+def load_spotify_credentials() -> None:
+    from dotenv import load_dotenv
+
     dotenv_path = path.join(path.abspath(path.dirname(path.dirname(__file__))), ".env")
     load_dotenv(dotenv_path)
+
+
+def get_spotify_token() -> str:
+    from spotipy import prompt_for_user_token
+
+    load_spotify_credentials()
     # username = input("username = ")
-    username = "phelng"
-    token = prompt_for_user_token(
-        username,
-        "user-library-read streaming user-read-currently-playing user-read-playback-state",
-    )
+    token = prompt_for_user_token(SPOTIFY_USERNAME, SPOTIFY_SCOPE)
     return token
 
 
-def get_authed_client(token: str) -> Spotify:
+def get_spotify_auth_manager() -> "SpotifyOAuth":
+    """
+    Unlike a token from `get_spotify_token`, which expires after an hour,
+    the auth manager refreshes the access token when needed.
+    It uses the same token cache as `get_spotify_token`.
+    """
+    from spotipy import SpotifyOAuth
+
+    load_spotify_credentials()
+    return SpotifyOAuth(scope=SPOTIFY_SCOPE, username=SPOTIFY_USERNAME)
+
+
+def get_authed_client(token: str) -> "Spotify":
+    from spotipy import Spotify
+
     return Spotify(auth=token)
 
 
@@ -82,7 +116,7 @@ def cover_art_cache(cover_art_url: str) -> str:
     filename = get_cover_art_id(cover_art_url) + ".jpg"
     filepath = path.join(cache_dir, filename)
     if not path.exists(filepath):
-        res = requests.get(cover_art_url, stream=True)
+        res = http_session().get(cover_art_url, stream=True)
         with open(filepath, "wb") as file:
             copyfileobj(res.raw, file)
 
@@ -94,8 +128,20 @@ def get_cover_art_id(cover_art_url: str) -> str:
 
 
 class SpotifyClient:
-    def __init__(self, client: Optional[Spotify] = None) -> None:
-        self.c = client or Spotify(auth=get_spotify_token())
+    def __init__(self, client: Optional["Spotify"] = None) -> None:
+        self._client = client
+
+    @property
+    def c(self) -> "Spotify":
+        """
+        The underlying spotipy client, authenticated on first use
+        """
+        if self._client is None:
+            from spotipy import Spotify
+
+            # Long-running processes (eg. --watch) outlive a single access token
+            self._client = Spotify(auth_manager=get_spotify_auth_manager())
+        return self._client
 
     def get_appropriate_track(self, track: Track) -> Optional[TrackSpotify]:
         results = self.c.search(self._build_search_query(track))["tracks"]["items"]
@@ -141,23 +187,53 @@ class SpotifyClient:
             total_tracks=len(album["tracks"]),
             cover_art_url=get_best_cover_art_url(album),
             label=album['label'],
+            spotify_id=track.get("id"),
         )
 
-    def get_playlist(self, playlist_id: str) -> List[TrackSpotify]:
-        results = self.c.playlist_tracks(playlist_id)
-        return self._get_all_from_paginated(results)
+    def get_playlist_snapshot(self, playlist_id: str) -> str:
+        """
+        Returns the playlist's snapshot ID, which changes whenever the playlist does
+        """
+        return self.c.playlist(playlist_id, fields="snapshot_id")["snapshot_id"]
 
-    def _get_all_from_paginated(self, results) -> List[TrackSpotify]:
+    def get_playlist(
+        self, playlist_id: str, skip_ids: AbstractSet[str] = frozenset()
+    ) -> List[TrackSpotify]:
+        """
+        Gets the playlist's tracks, except the ones whose spotify ID is in `skip_ids`
+        """
+        results = self.c.playlist_tracks(playlist_id)
+        return self._get_all_from_paginated(results, skip_ids)
+
+    def _get_all_from_paginated(
+        self,
+        results,
+        skip_ids: AbstractSet[str] = frozenset(),
+        stop_at_known_page: bool = False,
+    ) -> List[TrackSpotify]:
+        """
+        Gets the tracks of every page, except the ones whose spotify ID is in `skip_ids`
+        (these are not looked up, which saves an API call per track).
+        With `stop_at_known_page`, stops at the first page made only of such tracks.
+        """
+        is_new = lambda item: item["track"].get("id") not in skip_ids
         tracks = results["items"]
         while results["next"]:
+            if stop_at_known_page and not any(is_new(i) for i in results["items"] if i.get("track")):
+                break
             results = self.c.next(results)
             tracks.extend(results["items"])
-        tracks = [i["track"] for i in tracks if not i.get("is_local")]
+        tracks = [i["track"] for i in tracks if i.get("track") and not i.get("is_local") and is_new(i)]
         return [self.get_metadata(track) for track in tracks]
 
-    def get_saved_tracks(self) -> List[TrackSpotify]:
+    def get_saved_tracks(self, skip_ids: AbstractSet[str] = frozenset()) -> List[TrackSpotify]:
+        """
+        Gets the saved tracks, except the ones whose spotify ID is in `skip_ids`.
+        Saved tracks are sorted from the most recently added,
+        so pages past the first one made only of skipped tracks are not fetched.
+        """
         results = self.c.current_user_saved_tracks()
-        return self._get_all_from_paginated(results)
+        return self._get_all_from_paginated(results, skip_ids, stop_at_known_page=True)
 
 
 def apply_metadata(
@@ -166,6 +242,8 @@ def apply_metadata(
     try_to_convert=True,
     errors_hook=print,
 ):
+    import eyed3
+
     file = eyed3.load(filepath)
     if file is None:
         errors_hook("Can't load file with eyed3")
@@ -189,4 +267,50 @@ def apply_metadata(
     except AttributeError:
         pass
 
-    file.tag.save()
+    save_tag(file)
+
+
+def apply_loudness_tags(filepath, loudness: "Loudness", errors_hook=print):
+    """
+    Writes ReplayGain 2.0 and EBU R128 gain tags, so that players can normalize
+    the volume without the audio having to be re-encoded
+    """
+    import eyed3
+
+    file = eyed3.load(filepath)
+    if file is None:
+        errors_hook("Can't load file with eyed3")
+        return
+    if file.tag == None:
+        file.initTag()
+
+    file.tag.user_text_frames.set(f"{loudness.replaygain_gain:.2f} dB", "REPLAYGAIN_TRACK_GAIN")
+    file.tag.user_text_frames.set(f"{loudness.peak:.6f}", "REPLAYGAIN_TRACK_PEAK")
+    file.tag.user_text_frames.set(str(loudness.r128_gain), "R128_TRACK_GAIN")
+    save_tag(file)
+
+
+def save_tag(file) -> bool:
+    """
+    Saves the file's tag. eyed3 writes it in place if it fits in the current tag
+    (including its padding), otherwise it rewrites the whole file: the new tag is then
+    given TAG_PADDING bytes of padding instead of eyed3's default of 256.
+    Returns whether the whole file was rewritten to make room for a bigger tag.
+    """
+    import eyed3.id3.tag
+
+    size_before = file.tag.file_info.tag_size
+    default_padding = eyed3.id3.tag.DEFAULT_PADDING
+    eyed3.id3.tag.DEFAULT_PADDING = TAG_PADDING
+    try:
+        file.tag.save()
+    finally:
+        eyed3.id3.tag.DEFAULT_PADDING = default_padding
+    if not size_before:
+        # The file had no tag: writing one always rewrites it, there is nothing to avoid
+        tag_writes["new"] += 1
+        return False
+    # Writing in place keeps the tag's size, padding included
+    rewritten = file.tag.file_info.tag_size != size_before
+    tag_writes["full rewrite" if rewritten else "in place"] += 1
+    return rewritten
@@ -0,0 +1,78 @@
+from datetime import date
+from typing import *
+import json
+from phelng.metadata import Track, TrackSpotify
+from phelng.youtube import YoutubeVideo
+
+
+class Resolution(NamedTuple):
+    """
+    Everything needed to download and tag a track, without calling any API
+    """
+
+    track: Track
+    # Spotify's metadata, or the track itself if Spotify had no results
+    metadata: Union[Track, TrackSpotify]
+    # YouTube search results, to be ranked
+    candidates: List[YoutubeVideo]
+    # The candidate selected by the Ranker, if any
+    video: Optional[YoutubeVideo]
+
+
+def resolution_to_json(resolution: Resolution) -> str:
+    metadata = None
+    if isinstance(resolution.metadata, TrackSpotify):
+        metadata = resolution.metadata._asdict()
+        metadata["release_date"] = (
+            resolution.metadata.release_date and resolution.metadata.release_date.isoformat()
+        )
+    return json.dumps(
+        {
+            "track": resolution.track._asdict(),
+            "metadata": metadata,
+            "candidates": [video._asdict() for video in resolution.candidates],
+            "video_id": resolution.video and resolution.video.video_id,
+        },
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+def resolution_from_json(line: str) -> Resolution:
+    data = json.loads(line)
+    track = Track(**data["track"])
+    metadata: Union[Track, TrackSpotify] = track
+    if data["metadata"] is not None:
+        release_date = data["metadata"]["release_date"]
+        metadata = TrackSpotify(
+            **{
+                **data["metadata"],
+                "release_date": release_date and date.fromisoformat(release_date),
+            }
+        )
+    candidates = [YoutubeVideo(**video) for video in data["candidates"]]
+    video = next((v for v in candidates if v.video_id == data["video_id"]), None)
+    return Resolution(track=track, metadata=metadata, candidates=candidates, video=video)
+
+
+class PlanWriter:
+    """
+    Writes resolutions to a plan file, one JSON object per line.
+    Each row is written as soon as it is resolved, so an interrupted run still leaves a usable plan.
+    """
+
+    def __init__(self, filepath: str) -> None:
+        self.filepath = filepath
+        open(filepath, "w").close()
+
+    def add(self, resolution: Resolution) -> None:
+        with open(self.filepath, "a") as file:
+            file.write(resolution_to_json(resolution) + "\n")
+
+
+def read_plan(filepath: str) -> List[Resolution]:
+    return [
+        resolution_from_json(line)
+        for line in open(filepath).read().split("\n")
+        if line.strip()
+    ]
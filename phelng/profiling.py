@@ -0,0 +1,154 @@
+from contextlib import contextmanager
+from functools import wraps
+from os import makedirs, path
+from threading import Lock
+import sys
+from typing import *
+
+if TYPE_CHECKING:
+    import cProfile
+    import tracemalloc
+
+
+class StageProfiler:
+    """
+    Profiles each stage of the pipeline separately (CPU time with cProfile,
+    memory with tracemalloc), for one track out of every `every`.
+
+    tracemalloc can't snapshot memory at its peak: the peak size is exact,
+    but the top allocators are taken from a snapshot at the end of the stage.
+    """
+
+    def __init__(self, directory: str, every: int = 1) -> None:
+        self.directory = directory
+        self.every = every
+        self.sampling = False
+        self.tracks_count = 0
+        self.sampled_tracks_count = 0
+        # Profiles of each stage, for the main thread and for the threads it started
+        self.profiles: Dict[str, List["cProfile.Profile"]] = {}
+        self.peaks: Dict[str, int] = {}
+        self.snapshots: Dict[str, "tracemalloc.Snapshot"] = {}
+        self.current_stage: Optional[str] = None
+        self.lock = Lock()
+
+    def next_track(self) -> None:
+        self.sampling = self.tracks_count % self.every == 0
+        self.tracks_count += 1
+        self.sampled_tracks_count += self.sampling
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        # Stages don't nest: only one cProfile profiler can be enabled per thread
+        if not self.sampling or self.current_stage is not None:
+            yield
+            return
+        import cProfile
+        import tracemalloc
+
+        profile = cProfile.Profile()
+        self.current_stage = name
+        tracemalloc.start()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self.current_stage = None
+            with self.lock:
+                self.profiles.setdefault(name, []).append(profile)
+            if peak >= self.peaks.get(name, 0):
+                self.peaks[name] = peak
+                self.snapshots[name] = snapshot
+
+    def in_current_stage(self, function: Callable) -> Callable:
+        """
+        Wraps `function` so that, when it runs in another thread,
+        it is profiled as part of the current stage
+        """
+        stage = self.current_stage
+        # Since Python 3.12, cProfile records the calls of every thread,
+        # and only one profiler can be enabled at a time
+        if stage is None or sys.version_info >= (3, 12):
+            return function
+        import cProfile
+
+        @wraps(function)
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is already active: profiling must not make the call fail
+                return function(*args, **kwargs)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self.lock:
+                    self.profiles.setdefault(stage, []).append(profile)
+
+        return profiled
+
+    def write(self, top: int = 15) -> str:
+        """
+        Writes a .pstats file per stage (loadable with `python -m pstats`)
+        and a summary of the hot spots and allocators of every stage.
+        Returns the path to the summary.
+        """
+        import io
+        import pstats
+
+        makedirs(self.directory, exist_ok=True)
+        summary = io.StringIO()
+        summary.write(
+            f"Profiled {self.sampled_tracks_count} of {self.tracks_count} track(s)\n"
+        )
+        for name, profiles in self.profiles.items():
+            stats = pstats.Stats(*profiles, stream=summary)
+            stats.dump_stats(path.join(self.directory, f"{name}.pstats"))
+            summary.write(f"\n{'=' * 80}\n{name}\n{'=' * 80}\n")
+            summary.write(f"Peak traced memory: {self.peaks.get(name, 0) / 1e6:.1f} MB\n")
+            stats.sort_stats("cumulative").print_stats(top)
+            if name in self.snapshots:
+                summary.write(f"Top allocators (at the end of the stage):\n")
+                for statistic in self.snapshots[name].statistics("lineno")[:top]:
+                    summary.write(f"    {statistic}\n")
+
+        summary_filepath = path.join(self.directory, "summary.txt")
+        with open(summary_filepath, "w") as file:
+            file.write(summary.getvalue())
+        return summary_filepath
+
+
+# The profiler of the current run, if --profile was given
+profiler: Optional[StageProfiler] = None
+
+
+def start_profiling(directory: str, every: int = 1) -> StageProfiler:
+    global profiler
+    profiler = StageProfiler(directory, every)
+    return profiler
+
+
+def stage(name: str) -> ContextManager[None]:
+    """
+    Marks a stage of the pipeline, to be profiled separately if profiling is enabled
+    """
+    if profiler is None:
+        return _no_op()
+    return profiler.stage(name)
+
+
+def in_current_stage(function: Callable) -> Callable:
+    if profiler is None:
+        return function
+    return profiler.in_current_stage(function)
+
+
+@contextmanager
+def _no_op() -> Iterator[None]:
+    yield
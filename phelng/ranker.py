@@ -34,7 +34,7 @@ class Ranker:
         cprint(f'    <dim>https://youtube.com/watch?v={video.video_id}</dim> duration check: <b><{"green" if ret else "red"}>{ret}</>  {self.track.duration}s -> {video.duration}s')
         return ret
 
-    def uploader_name(self, video: YoutubeVideo) -> bool:
+    def uploader_name(self, video: YoutubeVideo, quiet: bool = False) -> bool:
         """
         Gives a score based on the uploader name
         """
@@ -47,10 +47,11 @@ class Ranker:
         ret = any((artist.lower() == video.uploader_name.replace(' - Topic', '').lower() for artist in artists))
         if hasattr(self.track, 'label'):
             ret = ret or self.track.label.lower() == video.uploader_name.lower()
-        cprint(f'    <dim>https://youtube.com/watch?v={video.video_id}</dim> uploader_name check: <b><{"green" if ret else "red"}>{ret}</>  {artists} -> {video.uploader_name}')
+        if not quiet:
+            cprint(f'    <dim>https://youtube.com/watch?v={video.video_id}</dim> uploader_name check: <b><{"green" if ret else "red"}>{ret}</>  {artists} -> {video.uploader_name}')
         return ret
 
-    def title(self, video: YoutubeVideo) -> bool:
+    def title(self, video: YoutubeVideo, quiet: bool = False) -> bool:
         """
         Checks if the video title contains the track's
         (will be fuzzy-matching in the future)
@@ -60,9 +61,17 @@ class Ranker:
         symbols = '-()' # Used by tracks on spotify to separate feat./remix statements from actual title.
         words = [w for w in words if w not in symbols]
         ret = any(( w for w in words if w in video.title.lower() ))
-        cprint(f'    <dim>https://youtube.com/watch?v={video.video_id}</dim> title check: <b><{"green" if ret else "red"}>{ret}</>  {words} -> {video.title!r}')
+        if not quiet:
+            cprint(f'    <dim>https://youtube.com/watch?v={video.video_id}</dim> title check: <b><{"green" if ret else "red"}>{ret}</>  {words} -> {video.title!r}')
         return ret
 
+    def is_obvious_choice(self, video: YoutubeVideo) -> bool:
+        """
+        Checks whether `select` would pick this video regardless of the others.
+        Doesn't log the checks, since `select` will.
+        """
+        return self.title(video, quiet=True) and self.uploader_name(video, quiet=True)
+
     def select(self, videos: List[YoutubeVideo]) -> Optional[YoutubeVideo]:
         """
         Selects the YouTube video to serve as the audio source
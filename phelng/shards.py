@@ -0,0 +1,96 @@
+from glob import glob
+from hashlib import sha1
+from os import makedirs, path
+from typing import *
+import re
+from phelng.metadata import Track
+from phelng.library_files import track_key
+
+
+class Shard(NamedTuple):
+    index: int  # from 1 to count
+    count: int
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    def __contains__(self, track: Track) -> bool:
+        return shard_of(track, self.count) == self.index
+
+
+def parse_shard(spec: str) -> Shard:
+    """
+    Parses a shard specification like "2/5" (the second of five shards).
+    Raises `ValueError` if the specification is invalid.
+    """
+    match = re.match(r"^(\d+)/(\d+)$", spec.strip())
+    if not match:
+        raise ValueError(f"invalid shard {spec!r}, expected I/N (eg. 1/4)")
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise ValueError(f"invalid shard {spec!r}, I must be between 1 and N")
+    return Shard(index=index, count=count)
+
+
+def shard_of(track: Track, count: int) -> int:
+    """
+    Returns the (1-based) index of the shard `track` belongs to.
+    Uses a cryptographic hash instead of `hash` so that every machine agrees.
+    """
+    digest = sha1(track_key(track).encode("utf-8")).hexdigest()
+    return int(digest, 16) % count + 1
+
+
+class ShardManifest:
+    """
+    Records which rows a shard completed, in a file of its own
+    so that workers never have to write to the same file.
+    Rows are formatted as artist, title, album, status ("done" or "failed") and filename.
+    """
+
+    def __init__(self, shard: Shard, directory: str) -> None:
+        makedirs(directory, exist_ok=True)
+        self.filepath = path.join(directory, f"shard-{shard.index}-of-{shard.count}.tsv")
+
+    def record(self, track: Track, filename: Optional[str]) -> None:
+        with open(self.filepath, "a") as file:
+            file.write(
+                "\t".join(
+                    (
+                        track.artist,
+                        track.title,
+                        track.album or "",
+                        "done" if filename else "failed",
+                        filename or "",
+                    )
+                )
+                + "\n"
+            )
+
+
+def merge_manifests(
+    library: Iterable[Track], directory: str
+) -> Tuple[Dict[Track, str], List[Track]]:
+    """
+    Combines the manifests in `directory`.
+    Returns the filenames of the completed tracks and the tracks no shard completed.
+    """
+    completed_keys: Dict[str, str] = {}
+    for filepath in sorted(glob(path.join(directory, "shard-*-of-*.tsv"))):
+        for line in open(filepath).read().split("\n"):
+            cells = line.split("\t")
+            if len(cells) != 5:
+                continue
+            artist, title, album, status, filename = cells
+            if status == "done":
+                completed_keys[track_key(Track(artist, title, album or None))] = filename
+
+    completed: Dict[Track, str] = {}
+    missing: List[Track] = []
+    for track in library:
+        key = track_key(track)
+        if key in completed_keys:
+            completed[track] = completed_keys[key]
+        else:
+            missing.append(track)
+    return completed, missing
@@ -0,0 +1,48 @@
+from hashlib import sha1
+from os import makedirs, path
+from typing import *
+import json
+from phelng.utils import cache_dir
+
+
+class PlaylistSyncState(NamedTuple):
+    # None for the saved tracks, which have no snapshot
+    snapshot_id: Optional[str]
+    # Spotify IDs of the tracks that were already imported
+    track_ids: Set[str]
+
+
+class SyncStates:
+    """
+    Remembers, for a library file, what was imported from each playlist
+    the last time it was added to it with --add-to
+    """
+
+    def __init__(self, library_file: str) -> None:
+        library_id = sha1(path.abspath(library_file).encode("utf-8")).hexdigest()
+        self.filepath = path.join(cache_dir, "sync", library_id + ".json")
+        self.states: Dict[str, PlaylistSyncState] = {}
+        if path.exists(self.filepath):
+            with open(self.filepath) as file:
+                for playlist_id, state in json.load(file).items():
+                    self.states[playlist_id] = PlaylistSyncState(
+                        snapshot_id=state["snapshot_id"], track_ids=set(state["track_ids"])
+                    )
+
+    def get(self, playlist_id: str) -> PlaylistSyncState:
+        return self.states.get(playlist_id, PlaylistSyncState(snapshot_id=None, track_ids=set()))
+
+    def set(self, playlist_id: str, state: PlaylistSyncState) -> None:
+        self.states[playlist_id] = state
+        makedirs(path.dirname(self.filepath), exist_ok=True)
+        with open(self.filepath, "w") as file:
+            json.dump(
+                {
+                    playlist_id: {
+                        "snapshot_id": state.snapshot_id,
+                        "track_ids": sorted(state.track_ids),
+                    }
+                    for playlist_id, state in self.states.items()
+                },
+                file,
+            )
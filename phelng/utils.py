@@ -2,7 +2,9 @@ from os.path import expanduser
 from typing import *
 import os, sys
 from shutil import get_terminal_size
-from pastel import colorize
+
+if TYPE_CHECKING:
+    import requests
 
 def create_missing_files(*files) -> None:
     for file in files:
@@ -54,7 +56,23 @@ def make_filename_safe(o: str, substitute: str = '-', remove_whitespace: bool =
 
 cache_dir = expanduser('~/.cache/phelng')
 
-def cprint(msg: str) -> None:
+_http_session: Optional["requests.Session"] = None
+
+def http_session() -> "requests.Session":
+    """
+    Returns a process-wide requests session, so that connections to YouTube
+    and Spotify's image CDN are kept alive between tracks.
+    """
+    global _http_session
+    if _http_session is None:
+        import requests
+
+        _http_session = requests.Session()
+    return _http_session
+
+def cprint(msg: str, file=None) -> None:
+    from pastel import colorize
+
     print(
         colorize(
             msg.replace("<b>", "<options=bold>")
@@ -65,5 +83,6 @@ def cprint(msg: str) -> None:
             .replace("</green>", "</fg=green>")
             .replace("<dim>", "<options=dark>")
             .replace("</dim>", "</options=dark>")
-        )
+        ),
+        file=file,
     )
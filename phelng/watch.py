@@ -0,0 +1,71 @@
+from os import path
+from time import sleep
+from typing import *
+from phelng.metadata import Track
+from phelng.library_files import is_library_row, parse_tsv_line
+from phelng.utils import cprint
+
+
+class LibraryTail:
+    """
+    Follows library files and returns the rows appended to them since the last poll.
+    New rows are found by byte offset, so content already seen is never read again.
+    """
+
+    def __init__(self, files: List[str]) -> None:
+        self.offsets = {file: path.getsize(file) for file in files}
+
+    def poll(self) -> List[str]:
+        lines = []
+        for file, offset in self.offsets.items():
+            size = path.getsize(file)
+            # The file was truncated or rewritten: start over from its beginning.
+            # Rows that were already processed are filtered out by `watch`.
+            if size < offset:
+                cprint(f"<b>Watch:</b>       <dim>{file} was truncated, rescanning it</dim>")
+                offset = self.offsets[file] = 0
+            if size == offset:
+                continue
+            with open(file, "rb") as f:
+                f.seek(offset)
+                chunk = f.read(size - offset)
+            # Leave incomplete lines (the writer hasn't finished yet) for the next poll
+            end = chunk.rfind(b"\n")
+            if end == -1:
+                continue
+            self.offsets[file] = offset + end + 1
+            lines.extend(chunk[:end].decode("utf-8").split("\n"))
+        return lines
+
+
+def watch(
+    tail: LibraryTail,
+    on_track: Callable[[Track], None],
+    seen: Set[str],
+    interval: float = 2,
+) -> None:
+    """
+    Calls `on_track` for every row appended to the files followed by `tail`, until interrupted.
+    `tail` must be created before the files are first read, so that rows appended
+    in the meantime are not missed. Rows in `seen` (and rows processed since) are skipped.
+    A row that fails to be processed doesn't stop the watch.
+    """
+    cprint(f"<b>Watch:</b>       <dim>Waiting for new rows in</dim> {', '.join(tail.offsets)}")
+    try:
+        while True:
+            for line in tail.poll():
+                if not is_library_row(line) or line in seen:
+                    continue
+                seen.add(line)
+                try:
+                    track = parse_tsv_line(line)
+                except ValueError as error:
+                    cprint(f"<red>  Error:     at line {line!r}: {error}</red>")
+                    continue
+                try:
+                    on_track(track)
+                except Exception as error:
+                    cprint(f"<red>  Error:     while processing {line!r}: {error}</red>")
+            sleep(interval)
+    except KeyboardInterrupt:
+        cprint(f"\n<b>Watch:</b>       <dim>Stopped.</dim>")
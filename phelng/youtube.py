@@ -1,9 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import *
 import urllib.parse
 import json
-from bs4 import BeautifulSoup
-import requests
 import re
+from phelng.profiling import in_current_stage
+from phelng.utils import cprint, http_session
 
 
 class YoutubeVideo(NamedTuple):
@@ -19,6 +20,8 @@ class YoutubeVideo(NamedTuple):
 
 
 def parse_results_html(results_html: str) -> List[YoutubeVideo]:
+    from bs4 import BeautifulSoup
+
     results = []
     viewcount_extract_pattern = re.compile(r"[^\d]*([\d ]+)[^\d]*")
     soup = BeautifulSoup(results_html, "html.parser")
@@ -54,7 +57,7 @@ def parse_results_html(results_html: str) -> List[YoutubeVideo]:
 def get_results_html(query: str) -> str:
     encoded_search = urllib.parse.quote(query)
     url = f"https://youtube.com/results?search_query={encoded_search}&pbj=1"
-    return requests.get(url).text
+    return http_session().get(url).text
 
 
 def search(query: str) -> List[YoutubeVideo]:
@@ -63,3 +66,44 @@ def search(query: str) -> List[YoutubeVideo]:
         f.write(results)
     videos = parse_results_html(results)
     return videos
+
+
+def search_many(
+    queries: List[str],
+    stop_when: Callable[[YoutubeVideo], bool] = lambda video: False,
+    max_workers: int = 4,
+) -> List[YoutubeVideo]:
+    """
+    Searches for all `queries` concurrently, and merges their results (in the order of `queries`),
+    without duplicate videos.
+    As soon as a video satisfies `stop_when`, the remaining queries are cancelled.
+    """
+    results: Dict[str, List[YoutubeVideo]] = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(queries))))
+    # Searches run in other threads, which must be profiled explicitly
+    search_one = in_current_stage(lambda query: parse_results_html(get_results_html(query)))
+    futures = {executor.submit(search_one, query): query for query in queries}
+    try:
+        for future in as_completed(futures):
+            try:
+                videos = future.result()
+            except Exception as e:
+                cprint(f"<red>  Error:     Couldn't search for {futures[future]!r}: {e}</red>")
+                continue
+            results[futures[future]] = videos
+            if any(stop_when(video) for video in videos):
+                break
+    finally:
+        # Queries that already started can't be interrupted, but their results are ignored
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+    merged: List[YoutubeVideo] = []
+    seen_video_ids: Set[str] = set()
+    for query in queries:
+        for video in results.get(query, []):
+            if video.video_id not in seen_video_ids:
+                seen_video_ids.add(video.video_id)
+                merged.append(video)
+    return merged